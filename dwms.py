@@ -1,12 +1,18 @@
+import array
 import click
 import os
+import json
+import struct
+import sys
+import time
 import yaml
 import requests
 import logging
 
 from enum import IntEnum, Enum
 from elasticsearch import Elasticsearch
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 from operator import itemgetter
 from itertools import groupby
@@ -24,11 +30,12 @@ class Status(IntEnum):
     # Lower the better, like golf
     OKAY = 0
     IN_PROGRESS = 1
-    PARTIAL = 2
-    BAD_HEALTH = 3
-    TIMED_OUT = 4
-    MISSING = 5
-    FAILED = 6
+    SLOW = 2
+    PARTIAL = 3
+    BAD_HEALTH = 4
+    TIMED_OUT = 5
+    MISSING = 6
+    FAILED = 7
 
     def __str__(self):
         return self.name.replace('_', ' ')
@@ -47,6 +54,7 @@ class Color(Enum):
     # Status -> colors
     OKAY = 'good'
     IN_PROGRESS = 'warning'
+    SLOW = 'warning'
     PARTIAL = 'warning'
     BAD_HEALTH = 'danger'
     TIMED_OUT = 'danger'
@@ -54,9 +62,120 @@ class Color(Enum):
     FAILED = 'danger'
 
 
+# Repository catalog snapshot states (SnapshotState byte values)
+SNAPSHOT_STATES = {
+    0: 'IN_PROGRESS',
+    1: 'SUCCESS',
+    2: 'FAILED',
+    3: 'PARTIAL',
+    4: 'INCOMPATIBLE'
+}
+
+
+def is_local_repository(repository_config):
+    """
+    Check if a repository can be read straight from its storage.
+
+    Args:
+        repository_config: repository specific config
+
+    Returns:
+        True if the repository is an fs repository with a reachable location
+    """
+    return (
+        repository_config.get('type') == 'fs' and
+        'location' in repository_config
+    )
+
+
+def needs_cluster(cluster_config):
+    """
+    Check if any repository for a cluster has to go through the cluster API.
+
+    Args:
+        cluster_config: cluster specific config
+
+    Returns:
+        True if at least one repository is not locally readable
+    """
+    return not all(
+        is_local_repository(repository_config)
+        for repository_config in cluster_config['repositories'].values()
+    )
+
+
+def read_blob(path):
+    """
+    Read a repository blob.
+
+    Args:
+        path: path to blob
+
+    Returns:
+        Contents of the blob as bytes
+    """
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def get_latest_generation(location):
+    """
+    Find the current catalog generation of a repository. Uses index.latest
+    if present, otherwise the highest index-N blob.
+
+    Args:
+        location: path to the repository
+
+    Returns:
+        Latest generation number, -1 if the repository is empty
+    """
+    latest = os.path.join(location, 'index.latest')
+    if os.path.exists(latest):
+        return struct.unpack('>q', read_blob(latest)[:8])[0]
+
+    generations = [
+        int(name[len('index-'):]) for name in os.listdir(location)
+        if name.startswith('index-') and name[len('index-'):].isdigit()
+    ]
+    return max(generations, default=-1)
+
+
+def get_local_snapshots(repository_config):
+    """
+    Get list of snapshots from the repository catalog (index-N) on disk.
+
+    Note:
+        Older (5.x) catalogs don't record the snapshot state, and snapshots
+        that are still running aren't in the catalog at all. Entries
+        without a state come back as UNKNOWN, see
+        :func:`resolve_local_snapshots`.
+
+    Args:
+        repository_config: repository specific config
+
+    Returns:
+        Returns list of snapshots in the same shape as cat.snapshots
+    """
+    location = repository_config['location']
+    generation = get_latest_generation(location)
+    if generation < 0:
+        return []
+
+    catalog = read_blob(os.path.join(location, f'index-{generation}'))
+    catalog = json.loads(catalog.decode('utf-8'))
+    return [
+        {
+            'id': s['name'],
+            'status': SNAPSHOT_STATES.get(s.get('state'), 'UNKNOWN')
+        }
+        for s in catalog.get('snapshots', [])
+    ]
+
+
 def get_snapshots(cluster_config, repository):
     """
-    Get list of snapshots.
+    Get list of snapshots. Local fs repositories are read directly from
+    storage, everything else goes through the cluster.
 
     Args:
         cluster_config: cluster specific config
@@ -65,6 +184,10 @@ def get_snapshots(cluster_config, repository):
     Returns:
         Returns list of snapshots from the given cluster:repo
     """
+    repository_config = cluster_config['repositories'][repository]
+    if is_local_repository(repository_config):
+        return get_local_snapshots(repository_config)
+
     es = cluster_config['es']
     snapshots = es.cat.snapshots(
         repository=repository,
@@ -74,12 +197,362 @@ def get_snapshots(cluster_config, repository):
     return snapshots
 
 
-def check_snapshots(cluster_config):
+def get_snapshot_states(cluster_config, repository, names):
+    """
+    Get the states of specific snapshots through the cluster, including
+    ones that are still running.
+
+    Args:
+        cluster_config: cluster specific config
+        repository: repository name
+        names: snapshot names
+
+    Returns:
+        Dictionary of snapshot name -> state for the snapshots that exist
+    """
+    es = cluster_config['es']
+    response = es.snapshot.get(
+        repository=repository,
+        snapshot=','.join(names),
+        ignore_unavailable=True,
+        request_timeout=300
+    )
+    return {s['snapshot']: s['state'] for s in response['snapshots']}
+
+
+def resolve_local_snapshots(cluster_config, repository, snapshots, patterns, healthy):
+    """
+    Fill in what the repository catalog can't tell: the state of entries
+    without one and snapshots that are still running (not in the catalog
+    yet). Only the patterns in question are asked for through the cluster.
+
+    If the cluster can't be asked, snapshots not in the catalog are assumed
+    to be in progress rather than missing, and entries without a state
+    stay UNKNOWN (which counts as failed).
+
+    Args:
+        cluster_config: cluster specific config
+        repository: repository name
+        snapshots: dictionary of snapshot name -> state from the catalog
+        patterns: snapshot names we're looking for
+        healthy: whether the cluster can be asked
+
+    Returns:
+        Dictionary of snapshot name -> state
+    """
+    unresolved = [
+        p for p in patterns if snapshots.get(p, 'UNKNOWN') == 'UNKNOWN'
+    ]
+    if not unresolved:
+        return snapshots
+
+    states = None
+    if healthy:
+        try:
+            states = get_snapshot_states(cluster_config, repository, unresolved)
+        except:
+            pass
+
+    snapshots = dict(snapshots)
+    for name in unresolved:
+        if states is not None:
+            if name in states:
+                snapshots[name] = states[name]
+        elif name not in snapshots:
+            snapshots[name] = 'IN_PROGRESS'
+
+    return snapshots
+
+
+# Columns kept per cluster:repo and their array typecodes
+HISTORY_COLUMNS = (
+    ('start_epoch', 'q'),
+    ('duration', 'd'),
+    ('total_shards', 'q'),
+    ('failed_shards', 'q')
+)
+
+# History file header: magic and row count (little-endian)
+HISTORY_MAGIC = b'DWMS'
+HISTORY_HEADER = struct.Struct('<4sq')
+
+# Rows kept per cluster:repo, earliest started are dropped first
+HISTORY_LIMIT = 1000
+
+# Defaults for settings.history
+HISTORY_DEFAULTS = {
+    'window': 30,
+    'threshold': 2.0,
+    'min_delta': 60,
+    'min_samples': 5
+}
+
+
+class SnapshotHistory:
+    """
+    Columnar history of finished snapshots for a single cluster:repo. The
+    columns are flat arrays stored back to back in a single file at
+    ``path``, after a small header and followed by the snapshot names. A
+    history that can't be read (or doesn't add up) is started over.
+
+    Args:
+        path: file to keep the history in
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.clear()
+
+        if not os.path.exists(path):
+            return
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            self.load(data)
+        except (OSError, ValueError, UnicodeDecodeError, struct.error):
+            self.clear()
+            return
+
+        # A full history was trimmed, anything older than what's left was
+        # dropped on purpose and shouldn't come back
+        if len(self.ids) >= HISTORY_LIMIT:
+            self.floor = min(self.columns['start_epoch'])
+
+    def load(self, data):
+        """
+        Load rows from the contents of a history file.
+
+        Args:
+            data: bytes as written by :func:`SnapshotHistory.save`
+
+        Raises:
+            ValueError: if the data doesn't add up
+        """
+        magic, count = HISTORY_HEADER.unpack_from(data)
+        if magic != HISTORY_MAGIC or count < 0:
+            raise ValueError('Not a history file')
+
+        offset = HISTORY_HEADER.size
+        for column in self.columns.values():
+            size = count * column.itemsize
+            if len(data) < offset + size:
+                raise ValueError('Truncated history file')
+            column.frombytes(data[offset:offset + size])
+            if sys.byteorder == 'big':
+                column.byteswap()
+            offset += size
+
+        self.ids = data[offset:].decode('utf-8').split()
+        if len(self.ids) != count:
+            raise ValueError('History names and columns disagree')
+        self.rows = {name: i for i, name in enumerate(self.ids)}
+
+    def clear(self):
+        """
+        Drop every row.
+        """
+        self.ids = []
+        self.rows = {}
+        self.floor = None
+        self.columns = {
+            name: array.array(typecode) for name, typecode in HISTORY_COLUMNS
+        }
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, snapshot):
+        """
+        Record a snapshot row from cat.snapshots. Only successful snapshots
+        are recorded, so failed and partial ones don't skew the statistics.
+        Rows already recorded, lacking timings or trimmed off earlier are
+        ignored. A snapshot that was retaken (same name, other start)
+        replaces the old attempt.
+
+        Args:
+            snapshot: snapshot row (from :func:`get_snapshots`)
+
+        Returns:
+            True if the snapshot was recorded
+        """
+        if 'start_epoch' not in snapshot:
+            return False
+
+        start = int(snapshot['start_epoch'])
+        row = self.rows.get(snapshot['id'])
+        if row is not None:
+            if self.columns['start_epoch'][row] == start:
+                return False
+            self.remove(snapshot['id'])
+
+        if snapshot['status'] != 'SUCCESS':
+            return False
+        if self.floor is not None and start < self.floor:
+            return False
+
+        self.rows[snapshot['id']] = len(self.ids)
+        self.ids.append(snapshot['id'])
+        self.columns['start_epoch'].append(start)
+        self.columns['duration'].append(int(snapshot['end_epoch']) - start)
+        self.columns['total_shards'].append(int(snapshot.get('total_shards', 0)))
+        self.columns['failed_shards'].append(int(snapshot.get('failed_shards', 0)))
+        return True
+
+    def remove(self, name):
+        """
+        Drop a snapshot's row.
+
+        Args:
+            name: snapshot name
+        """
+        row = self.rows.pop(name)
+        del self.ids[row]
+        for column in self.columns.values():
+            del column[row]
+        self.rows = {name: i for i, name in enumerate(self.ids)}
+
+    def window(self, before, size):
+        """
+        Indexes of the latest ``size`` snapshots started before ``before``.
+
+        Args:
+            before: start epoch to look back from
+            size: window size
+
+        Returns:
+            List of row indexes, ordered by start
+        """
+        starts = self.columns['start_epoch']
+        rows = [i for i, start in enumerate(starts) if start < before]
+        rows.sort(key=starts.__getitem__)
+        return rows[-size:]
+
+    def stats(self, rows):
+        """
+        Rolling statistics over the given rows.
+
+        Args:
+            rows: row indexes (from :func:`SnapshotHistory.window`)
+
+        Returns:
+            Dictionary of sample count, duration percentiles (seconds) and
+            median shard throughput (shards per second)
+        """
+        durations = [self.columns['duration'][i] for i in rows]
+        shards = [self.columns['total_shards'][i] for i in rows]
+        throughput = [s / d for s, d in zip(shards, durations) if d > 0]
+        return {
+            'samples': len(rows),
+            'p50': percentile(durations, 50),
+            'p90': percentile(durations, 90),
+            'p95': percentile(durations, 95),
+            'throughput': percentile(throughput, 50)
+        }
+
+    def save(self):
+        """
+        Write the history back to disk, keeping the :data:`HISTORY_LIMIT`
+        latest started snapshots. The file is written aside and renamed
+        over the old one, so an interrupted save leaves the previous
+        history intact.
+        """
+        starts = self.columns['start_epoch']
+        keep = sorted(range(len(self.ids)), key=starts.__getitem__)
+        keep = keep[-HISTORY_LIMIT:]
+
+        data = [HISTORY_HEADER.pack(HISTORY_MAGIC, len(keep))]
+        for column in self.columns.values():
+            kept = array.array(column.typecode, (column[i] for i in keep))
+            if sys.byteorder == 'big':
+                kept.byteswap()
+            data.append(kept.tobytes())
+        data.append('\n'.join(self.ids[i] for i in keep).encode('utf-8'))
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f'{self.path}.tmp', 'wb') as f:
+            f.write(b''.join(data))
+        os.replace(f'{self.path}.tmp', self.path)
+
+
+def percentile(values, q):
+    """
+    Linearly interpolated percentile.
+
+    Args:
+        values: sequence of numbers
+        q: percentile, 0-100
+
+    Returns:
+        The percentile or None if there are no values
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def check_durations(cluster_config, repository, snapshots, names):
+    """
+    Record snapshot timings in the cluster:repo history and flag snapshots
+    that took longer than ``threshold`` times the rolling median duration,
+    and at least ``min_delta`` seconds longer (epochs are whole seconds, so
+    small repositories often have a median of 0).
+
+    Args:
+        cluster_config: cluster specific config
+        repository: repository name
+        snapshots: snapshot rows (from :func:`get_snapshots`)
+        names: snapshot names to evaluate
+
+    Returns:
+        Tuple of slow snapshots (name -> duration in seconds) and the
+        rolling stats of the latest window
+    """
+    settings = dict(HISTORY_DEFAULTS)
+    settings.update(cluster_config['settings']['history'])
+    history = SnapshotHistory(os.path.join(
+        settings['path'],
+        cluster_config['endpoint'],
+        f'{repository}.bin'
+    ))
+
+    for snapshot in snapshots:
+        history.add(snapshot)
+
+    slow = {}
+    for name in names:
+        if name not in history.rows:
+            continue
+
+        row = history.rows[name]
+        start = history.columns['start_epoch'][row]
+        duration = history.columns['duration'][row]
+        stats = history.stats(history.window(start, settings['window']))
+        if stats['samples'] < settings['min_samples']:
+            continue
+        if (
+            duration > stats['p50'] * settings['threshold'] and
+            duration - stats['p50'] >= settings['min_delta']
+        ):
+            slow[name] = duration
+
+    history.save()
+    stats = history.stats(history.window(float('inf'), settings['window']))
+    return slow, stats
+
+
+def check_snapshots(cluster_config, healthy=True):
     """
     Check if given patterns for a cluster exist.
 
     Args:
         cluster_config: cluster specific config
+        healthy: whether the cluster passed its health check, if not only
+            repositories read from storage are checked
 
     Returns:
         Dictionary of each cluster with corresponding snapshots grouped by
@@ -93,12 +566,39 @@ def check_snapshots(cluster_config):
         # Setup our results, patterns and snapshots
         repo_results = results[repository]
         patterns = repository_config['patterns']
-        try:
-            snapshots = get_snapshots(cluster_config, repository)
-        except:
-            repo_results['timed_out'] = True
+        started = time.monotonic()
+
+        if is_local_repository(repository_config):
+            try:
+                snapshots = get_snapshots(cluster_config, repository)
+            except (OSError, ValueError, struct.error) as e:
+                location = repository_config['location']
+                click.secho(f'Repository "{repository}" storage at "{location}" is unreadable! ({e})', err=True, fg='red')
+                repo_results['unreadable'] = True
+                repo_results['missing'] = patterns
+                repo_results['took'] = time.monotonic() - started
+                continue
+        elif not healthy:
+            repo_results['bad_health'] = True
             continue
+        else:
+            try:
+                snapshots = get_snapshots(cluster_config, repository)
+            except:
+                repo_results['timed_out'] = True
+                repo_results['took'] = time.monotonic() - started
+                continue
+
+        rows = snapshots
         snapshots = {s['id']: s['status'] for s in snapshots}
+        if is_local_repository(repository_config):
+            snapshots = resolve_local_snapshots(
+                cluster_config,
+                repository,
+                snapshots,
+                patterns,
+                healthy
+            )
 
         # Pop off the patterns that exist in the snapshots
         for s, v in snapshots.items():
@@ -122,21 +622,79 @@ def check_snapshots(cluster_config):
             if v == 'PARTIAL'
         }
 
-        # Failed snapshots
+        # Failed snapshots, anything we don't know to be okay (INCOMPATIBLE,
+        # UNKNOWN) counts too
         repo_results['failed'] = {
             s: v for s, v in repo_results['found'].items()
-            if v == 'FAILED'
+            if v not in ('SUCCESS', 'IN_PROGRESS', 'PARTIAL')
         }
 
+        # Snapshots that took much longer than usual (timings only come
+        # from the cluster API)
+        repo_results['slow'] = {}
+        history = cluster_config['settings'].get('history')
+        if history and not is_local_repository(repository_config):
+            try:
+                repo_results['slow'], repo_results['stats'] = check_durations(
+                    cluster_config,
+                    repository,
+                    rows,
+                    repo_results['found']
+                )
+            except OSError as e:
+                click.secho(f'Snapshot history at "{history["path"]}" is unusable! ({e})', err=True, fg='red')
+
+        repo_results['took'] = time.monotonic() - started
+
     return results
 
 
+def evaluate_repository(repo_statuses):
+    """
+    Takes the results of check_snapshots for a single repository and returns
+    a value based on the severity of the situation.
+
+    Args:
+        repo_statuses: status dict for a repository (from
+            :func:`check_snapshots`)
+
+    Returns:
+        Status of the repository
+    """
+    if repo_statuses.get('bad_health', False):
+        return Status.BAD_HEALTH
+
+    if repo_statuses.get('timed_out', False):
+        return Status.TIMED_OUT
+
+    # Can't read the storage, so everything is missing as far as we know
+    if repo_statuses.get('unreadable', False):
+        return Status.MISSING
+
+    # Evaluate each type
+    is_progress = len(repo_statuses['progress']) > 0
+    is_slow = len(repo_statuses.get('slow', {})) > 0
+    is_partial = len(repo_statuses['partial']) > 0
+    is_missing = len(repo_statuses['missing']) > 0
+    is_failed = len(repo_statuses['failed']) > 0
+
+    # Which is the highest?
+    repo_status = Status.OKAY
+    repo_status = Status.IN_PROGRESS if is_progress else repo_status
+    repo_status = Status.SLOW if is_slow else repo_status
+    repo_status = Status.PARTIAL if is_partial else repo_status
+    repo_status = Status.MISSING if is_missing else repo_status
+    repo_status = Status.FAILED if is_failed else repo_status
+
+    return repo_status
+
+
 def evaluate_snapshots(statuses):
     """
     Takes the results of check_snapshots for a cluster and returns a value
     based on the severity of the situation.
 
-    Severity ranges from 0-3; "Okay" to "Shit is broken, yo".
+    Severity ranges from 0-7; "Okay" to "Shit is broken, yo".
 
     Args:
         statuses: status dict for a cluster (from :func:`check_snapshots`)
@@ -144,29 +702,10 @@ def evaluate_snapshots(statuses):
     Returns:
         Maximum status level from the cluster
     """
-    cluster_statuses = []
-
-    for repo, repo_statuses in statuses.items():
-
-        if repo_statuses.get('timed_out', False):
-            repo_status = Status.TIMED_OUT
-            cluster_statuses.append(repo_status)
-            continue
-
-        # Evaluate each type
-        is_progress = len(repo_statuses['progress']) > 0
-        is_partial = len(repo_statuses['partial']) > 0
-        is_missing = len(repo_statuses['missing']) > 0
-        is_failed = len(repo_statuses['failed']) > 0
-
-        # Which is the highest?
-        repo_status = Status.OKAY
-        repo_status = Status.IN_PROGRESS if is_progress else repo_status
-        repo_status = Status.PARTIAL if is_partial else repo_status
-        repo_status = Status.MISSING if is_missing else repo_status
-        repo_status = Status.FAILED if is_failed else repo_status
-
-        cluster_statuses.append(repo_status)
+    cluster_statuses = [
+        evaluate_repository(repo_statuses)
+        for repo_statuses in statuses.values()
+    ]
 
     status = max(cluster_statuses)
 
@@ -261,6 +800,32 @@ def build_cluster_info(config):
     return config
 
 
+def check_history_settings(config):
+    """
+    Make sure every cluster tracking snapshot history has somewhere to keep
+    it. Clusters without a history path have tracking turned off (and are
+    told about it) rather than failing mid run.
+
+    Args:
+        config: global settings config
+
+    Returns:
+        Global settings config, with unusable history settings removed
+    """
+    for cluster in config['clusters']:
+        history = cluster['settings'].get('history')
+        if not history or history.get('path'):
+            continue
+
+        endpoint = cluster['endpoint']
+        click.secho(f'Cluster "{endpoint}" history has no path! Not tracking snapshot timings!', err=True, fg='red')
+
+        # Settings may be shared with the global ones, don't touch those
+        cluster['settings'] = dict(cluster['settings'], history=None)
+
+    return config
+
+
 def load_config(config):
     """
     Load config, expand env vars, and load yaml. Data is read in to avoid a very
@@ -397,10 +962,11 @@ def send_to_stdout(results):
         0: 'green',
         1: 'yellow',
         2: 'yellow',
-        3: 'red',
+        3: 'yellow',
         4: 'red',
         5: 'red',
-        6: 'red'
+        6: 'red',
+        7: 'red'
     }
 
     raw_messages = []
@@ -434,7 +1000,51 @@ def send_to_stdout(results):
         click.secho(status_line, err=True if level > 0 else False)
 
 
-def send_to_notifiers(results, config):
+def build_records(endpoint, status, statuses, took):
+    """
+    Build machine readable records for a cluster, one per repository and
+    one for the cluster itself (last).
+
+    Args:
+        endpoint: cluster endpoint
+        status: evaluated cluster status
+        statuses: status dict for the cluster (from :func:`check_snapshots`),
+            None if the cluster wasn't checked
+        took: seconds spent on the cluster
+
+    Yields:
+        Dictionaries ready to be dumped as JSON
+    """
+    for repository, repo_statuses in (statuses or {}).items():
+        repo_status = evaluate_repository(repo_statuses)
+        yield {
+            'type': 'repository',
+            'cluster': endpoint,
+            'repository': repository,
+            'status': repo_status.name,
+            'severity': repo_status.value,
+            'bad_health': repo_statuses.get('bad_health', False),
+            'timed_out': repo_statuses.get('timed_out', False),
+            'unreadable': repo_statuses.get('unreadable', False),
+            'missing': sorted(repo_statuses.get('missing', [])),
+            'progress': sorted(repo_statuses.get('progress', {})),
+            'partial': sorted(repo_statuses.get('partial', {})),
+            'failed': sorted(repo_statuses.get('failed', {})),
+            'slow': dict(repo_statuses.get('slow', {})),
+            'stats': repo_statuses.get('stats'),
+            'took': repo_statuses.get('took')
+        }
+
+    yield {
+        'type': 'cluster',
+        'cluster': endpoint,
+        'status': status.name,
+        'severity': status.value,
+        'took': took
+    }
+
+
+def send_to_notifiers(results, config, stdout=True):
     """
     Whip through each notifier and do the thing.
 
@@ -449,6 +1059,7 @@ def send_to_notifiers(results, config):
     Args:
         results: results from the complete evaluation of snapshots statuses
         config: global settings config (used for some notifiers)
+        stdout: whether the stdout notifier (or fallback) may be used
     """
 
     if 'notifiers' in config and len(config['notifiers']) > 0:
@@ -463,15 +1074,146 @@ def send_to_notifiers(results, config):
         if 'slack' in notifiers:
             send_to_slack(results, config)
 
-        if 'stdout' in notifiers and notifiers['stdout']:
+        if stdout and 'stdout' in notifiers and notifiers['stdout']:
             send_to_stdout(results)
 
-    else:
+    elif stdout:
         # You dummy, you didn't set any outputs
         click.echo('You have no notifiers set, dumping to stdout instead')
         send_to_stdout(results)
 
 
+# Transport defaults, overridden by global then cluster settings.transport
+TRANSPORT_DEFAULTS = {
+    'compress': True,
+    'maxsize': 10,
+    'keep_alive': True,
+    'ca_certs': None
+}
+
+
+def build_transport_settings(config, cluster_config):
+    """
+    Merge transport settings. Cluster transport settings take precedence
+    over global ones, key by key.
+
+    Args:
+        config: global settings config
+        cluster_config: cluster specific config
+
+    Returns:
+        Dictionary of transport settings for the cluster
+    """
+    transport = dict(TRANSPORT_DEFAULTS)
+    transport.update(config['settings'].get('transport') or {})
+    transport.update(cluster_config['settings'].get('transport') or {})
+    return transport
+
+
+def create_client(cluster_config, transport):
+    """
+    Create an Elasticsearch client for a single cluster.
+
+    Args:
+        cluster_config: cluster specific config
+        transport: transport settings (from :func:`build_transport_settings`)
+
+    Returns:
+        Elasticsearch client
+    """
+    auth = (
+        cluster_config['settings']['username'],
+        cluster_config['settings']['password']
+    )
+
+    headers = {
+        'connection': 'keep-alive' if transport['keep_alive'] else 'close'
+    }
+    if transport['compress']:
+        headers['accept-encoding'] = 'gzip,deflate'
+
+    return Elasticsearch(
+        cluster_config['endpoint'],
+        port=cluster_config['port'],
+        use_ssl=True if cluster_config['protocol'] == 'https' else False,
+        verify_certs=True,
+        http_auth=auth,
+        maxsize=transport['maxsize'],
+        headers=headers,
+        ca_certs=transport['ca_certs']
+    )
+
+
+class ClientPool:
+    """
+    Creates Elasticsearch clients on demand and keeps up to ``size`` of the
+    most recently used ones warm. Anything beyond that is closed as soon as
+    its cluster check is done, so open connections are bounded by the pool
+    size rather than the number of clusters.
+
+    Args:
+        config: global settings config
+        size: number of idle clients to keep around (0 to keep none)
+    """
+
+    def __init__(self, config, size=0):
+        self.config = config
+        self.size = size
+        self.clients = OrderedDict()
+
+    @contextmanager
+    def client(self, cluster_config):
+        """
+        Attach a client to the cluster config as ``es`` for the duration of
+        the block.
+
+        Args:
+            cluster_config: cluster specific config
+        """
+        # Everything the client is built from, so entries for the same
+        # endpoint with other credentials or settings don't share clients
+        transport = build_transport_settings(self.config, cluster_config)
+        key = (
+            cluster_config['protocol'],
+            cluster_config['endpoint'],
+            cluster_config['port'],
+            cluster_config['settings']['username'],
+            cluster_config['settings']['password'],
+            tuple(sorted(transport.items()))
+        )
+        es = self.clients.pop(key, None)
+        if es is None:
+            es = create_client(cluster_config, transport)
+
+        cluster_config['es'] = es
+        try:
+            yield es
+        finally:
+            del cluster_config['es']
+            self.release(key, es)
+
+    def release(self, key, es):
+        """
+        Return a client to the pool, closing whatever falls out of it.
+
+        Args:
+            key: key of the client (see :func:`ClientPool.client`)
+            es: Elasticsearch client
+        """
+        self.clients[key] = es
+        while len(self.clients) > self.size:
+            _, idle = self.clients.popitem(last=False)
+            idle.transport.close()
+
+    def close(self):
+        """
+        Close every idle client.
+        """
+        while self.clients:
+            _, idle = self.clients.popitem()
+            idle.transport.close()
+
+
 def create_clients(config):
     """
     Create Elasticsearch clients (do not test if they work, that's later).
@@ -480,17 +1222,8 @@ def create_clients(config):
         config: global settings config
     """
     for cluster_config in config['clusters']:
-        auth = (
-            cluster_config['settings']['username'],
-            cluster_config['settings']['password']
-        )
-        cluster_config['es'] = Elasticsearch(
-            cluster_config['endpoint'],
-            port=cluster_config['port'],
-            use_ssl=True if cluster_config['protocol'] == 'https' else False,
-            verify_certs=True,
-            http_auth=auth
-        )
+        transport = build_transport_settings(config, cluster_config)
+        cluster_config['es'] = create_client(cluster_config, transport)
 
     return config
 
@@ -513,7 +1246,14 @@ def create_clients(config):
     is_flag=True,
     help="Don't send info, show everything"
 )
-def main(config, date, debug):
+@click.option(
+    '-o',
+    '--output',
+    type=click.Choice(['text', 'json', 'ndjson']),
+    default='text',
+    help="Output format for stdout, ndjson streams per cluster"
+)
+def main(config, date, debug, output):
     """
     Check each cluster:repo(s) pair for the patterns specified in the config
     for the current day's snapshot(s).
@@ -521,34 +1261,53 @@ def main(config, date, debug):
     # Build settings
     config = load_config(config)
     config = build_cluster_info(config)
+    config = check_history_settings(config)
     config = build_patterns(config, date or datetime.now())
-    config = create_clients(config)
+    pool = ClientPool(config, config['settings'].get('client_pool_size', 0))
 
-    # Check if each cluster is accessible before checking
+    # Check each cluster, clients are only alive while their cluster is
+    # checked (or idle in the pool)
+    # TODO: needs catch for timeout, if timeout, status should read TIMEOUT
+    results = {}
+    records = []
     for cluster_config in config['clusters']:
         endpoint = cluster_config['endpoint']
-        health = check_credentials(cluster_config)
+        started = time.monotonic()
 
-        if not health:
-            click.secho(f'Cluster "{endpoint}" health check failed! Skipping!', err=True, fg='red')
-            cluster_config['ignore'] = True
+        with pool.client(cluster_config):
 
-    # Do snapshot checks for each cluster
-    # TODO: needs catch for timeout, if timeout, status should read TIMEOUT
-    results = {}
-    for cluster_config in config['clusters']:
-        if cluster_config.get('ignore', False):
-            results[cluster_config['endpoint']] = Status.BAD_HEALTH
-            continue
-        statuses = check_snapshots(cluster_config)
-        statuses = evaluate_snapshots(statuses)
-        results[cluster_config['endpoint']] = statuses
+            # Check if the cluster is accessible before checking (unless
+            # every repository can be read from storage directly), those
+            # read from storage are checked either way
+            healthy = (
+                not needs_cluster(cluster_config) or
+                check_credentials(cluster_config)
+            )
+            if not healthy:
+                click.secho(f'Cluster "{endpoint}" health check failed! Skipping API-backed repositories!', err=True, fg='red')
+
+            statuses = check_snapshots(cluster_config, healthy)
+            results[endpoint] = evaluate_snapshots(statuses)
+
+        # Structured output goes out as soon as each cluster is done
+        if output != 'text':
+            took = time.monotonic() - started
+            for record in build_records(endpoint, results[endpoint], statuses, took):
+                if output == 'ndjson':
+                    click.echo(json.dumps(record))
+                else:
+                    records.append(record)
+
+    pool.close()
+
+    if output == 'json':
+        click.echo(json.dumps(records, indent=2))
 
     # Send results to zabbix, hipchat, whatever, or stdout only if debug
     # TODO: debug should still use the notifiers, but dump their output instead
     if not debug:
-        send_to_notifiers(results, config)
-    else:
+        send_to_notifiers(results, config, stdout=output == 'text')
+    elif output == 'text':
         send_to_stdout(results)
 
 
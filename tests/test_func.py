@@ -1,6 +1,8 @@
 from .fixtures import cluster_config
 from datetime import datetime, timedelta
 import pytest
+import struct
+import json
 import dwms
 
 TODAY = datetime.now().strftime('%Y%m%d')
@@ -63,11 +65,397 @@ MIXED_FAILED = {
 }
 
 
+SLOW_RESULTS = {
+    'sample': {
+        'found': {
+            TODAY: 'SUCCESS'
+        },
+        'missing': {},
+        'progress': {},
+        'partial': {},
+        'failed': {},
+        'slow': {
+            TODAY: 600
+        }
+    }
+}
+
+
 @pytest.mark.parametrize('status,result', [
     (PROGRESS_RESULTS, dwms.Status.IN_PROGRESS),
+    (SLOW_RESULTS, dwms.Status.SLOW),
     (PARTIAL_RESULTS, dwms.Status.PARTIAL),
     (FAILED_RESULTS, dwms.Status.FAILED),
     (MIXED_FAILED, dwms.Status.FAILED)
 ])
 def test_snapshot_statuses(status, result):
     assert dwms.evaluate_snapshots(status) == result
+
+
+def test_local_snapshots(tmpdir):
+    """Ensure fs repository catalogs are read from disk"""
+    catalog = {
+        'snapshots': [
+            {'name': YESTERDAY, 'uuid': 'a'},
+            {'name': TODAY, 'uuid': 'b', 'state': 3}
+        ]
+    }
+    tmpdir.join('index-0').write('{}')
+    tmpdir.join('index-1').write(json.dumps(catalog))
+    tmpdir.join('index.latest').write_binary(struct.pack('>q', 1))
+    snapshots = dwms.get_local_snapshots({'type': 'fs', 'location': str(tmpdir)})
+    assert snapshots == [
+        {'id': YESTERDAY, 'status': 'UNKNOWN'},
+        {'id': TODAY, 'status': 'PARTIAL'}
+    ]
+
+
+def test_transport_settings():
+    """Ensure cluster transport settings override global ones per key"""
+    config = {'settings': {'transport': {'maxsize': 4, 'compress': False}}}
+    cluster_config = {'settings': {'transport': {'maxsize': 2}}}
+    transport = dwms.build_transport_settings(config, cluster_config)
+    assert transport['maxsize'] == 2
+    assert transport['compress'] is False
+    assert transport['keep_alive'] is True
+
+
+class FakeClient:
+
+    def __init__(self):
+        self.transport = self
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_client_pool(monkeypatch):
+    """Ensure clients are created lazily and evicted past the pool size"""
+    monkeypatch.setattr(dwms, 'create_client', lambda *args: FakeClient())
+    config = {'settings': {}}
+    clusters = [
+        {
+            'endpoint': endpoint,
+            'port': 9200,
+            'protocol': 'https',
+            'settings': {'username': 'demo', 'password': 'demo'},
+            'repositories': {'sample': {'type': 's3'}}
+        }
+        for endpoint in ('a', 'b')
+    ]
+    pool = dwms.ClientPool(config, size=1)
+
+    with pool.client(clusters[0]) as first:
+        assert clusters[0]['es'] is first
+    assert 'es' not in clusters[0]
+    assert not first.closed
+
+    with pool.client(clusters[1]):
+        pass
+    assert first.closed
+
+    pool.close()
+    assert not pool.clients
+
+
+def test_slow_snapshots(tmpdir):
+    """Ensure snapshots well past the rolling median are flagged"""
+    snapshots = [
+        {
+            'id': f'snap{x}',
+            'status': 'SUCCESS',
+            'start_epoch': str(1000 * x),
+            'end_epoch': str(1000 * x + 60),
+            'total_shards': '10',
+            'failed_shards': '0'
+        }
+        for x in range(5)
+    ]
+    snapshots.append({
+        'id': TODAY,
+        'status': 'SUCCESS',
+        'start_epoch': '5000',
+        'end_epoch': '5600',
+        'total_shards': '10',
+        'failed_shards': '0'
+    })
+    cluster_config = {
+        'endpoint': 'localhost',
+        'settings': {'history': {'path': str(tmpdir)}}
+    }
+    slow, stats = dwms.check_durations(cluster_config, 'sample', snapshots, {TODAY: 'SUCCESS'})
+    assert slow == {TODAY: 600}
+    assert stats['samples'] == 6
+
+    # History is persisted, so a rerun flags it again
+    slow, _ = dwms.check_durations(cluster_config, 'sample', snapshots[-1:], {TODAY: 'SUCCESS'})
+    assert slow == {TODAY: 600}
+
+
+def test_build_records():
+    """Ensure records are built per repository, then for the cluster"""
+    records = list(dwms.build_records('localhost', dwms.Status.FAILED, MIXED_FAILED, 1.5))
+    assert [r['type'] for r in records] == ['repository', 'cluster']
+    assert records[0]['status'] == 'FAILED'
+    assert records[0]['failed'] == [TODAY]
+    assert records[1] == {
+        'type': 'cluster',
+        'cluster': 'localhost',
+        'status': 'FAILED',
+        'severity': dwms.Status.FAILED.value,
+        'took': 1.5
+    }
+
+
+def test_unhealthy_mixed_cluster(tmpdir):
+    """Ensure local repositories are checked even if the cluster is unhealthy"""
+    tmpdir.join('index-0').write(json.dumps({'snapshots': [{'name': TODAY, 'state': 1}]}))
+    cluster_config = {
+        'settings': {},
+        'repositories': {
+            'local': {'type': 'fs', 'location': str(tmpdir), 'patterns': [TODAY]},
+            'remote': {'type': 's3', 'patterns': [TODAY]}
+        }
+    }
+    status = dwms.check_snapshots(cluster_config, healthy=False)
+    assert TODAY in status['local']['found']
+    assert dwms.evaluate_repository(status['local']) == dwms.Status.OKAY
+    assert dwms.evaluate_repository(status['remote']) == dwms.Status.BAD_HEALTH
+
+
+def test_unreadable_local_repository(tmpdir):
+    """Ensure an unreadable location is reported as such, not as a timeout"""
+    cluster_config = {
+        'settings': {},
+        'repositories': {
+            'local': {
+                'type': 'fs',
+                'location': str(tmpdir.join('unmounted')),
+                'patterns': [TODAY]
+            }
+        }
+    }
+    status = dwms.check_snapshots(cluster_config)
+    assert status['local']['unreadable']
+    assert not status['local'].get('timed_out')
+    assert dwms.evaluate_snapshots(status) == dwms.Status.MISSING
+
+
+def test_create_client(tmpdir):
+    """Ensure transport settings end up on the connection"""
+    ca_certs = tmpdir.join('ca.pem')
+    ca_certs.write('')
+    cluster_config = {
+        'endpoint': 'localhost',
+        'port': 9200,
+        'protocol': 'https',
+        'settings': {'username': 'demo', 'password': 'demo'}
+    }
+    transport = dict(dwms.TRANSPORT_DEFAULTS, keep_alive=False, ca_certs=str(ca_certs))
+    es = dwms.create_client(cluster_config, transport)
+    connection = es.transport.get_connection()
+    assert connection.headers['connection'] == 'close'
+    assert connection.headers['accept-encoding'] == 'gzip,deflate'
+    assert connection.pool.ca_certs == str(ca_certs)
+    assert connection.pool.pool.maxsize == transport['maxsize']
+
+
+def test_client_pool_key(monkeypatch):
+    """Ensure entries for one endpoint with other credentials don't share clients"""
+    monkeypatch.setattr(dwms, 'create_client', lambda *args: FakeClient())
+    clusters = [
+        {
+            'endpoint': 'a',
+            'port': 9200,
+            'protocol': 'https',
+            'settings': {'username': username, 'password': 'demo'},
+            'repositories': {'sample': {'type': 's3'}}
+        }
+        for username in ('demo', 'guy')
+    ]
+    pool = dwms.ClientPool({'settings': {}}, size=2)
+
+    with pool.client(clusters[0]) as first:
+        pass
+    with pool.client(clusters[1]) as second:
+        assert second is not first
+    with pool.client(clusters[0]) as again:
+        assert again is first
+
+
+def test_slow_snapshots_trimmed_history(tmpdir, monkeypatch):
+    """Ensure trimmed snapshots don't come back and skew the window"""
+    monkeypatch.setattr(dwms, 'HISTORY_LIMIT', 10)
+    snapshots = [
+        {
+            'id': f'snap{x}',
+            'status': 'SUCCESS',
+            'start_epoch': str(10000 * x),
+            'end_epoch': str(10000 * x + (1000 if x < 3 else 10)),
+            'total_shards': '10',
+            'failed_shards': '0'
+        }
+        for x in range(12)
+    ]
+    snapshots.append({
+        'id': TODAY,
+        'status': 'SUCCESS',
+        'start_epoch': '120000',
+        'end_epoch': '120100',
+        'total_shards': '10',
+        'failed_shards': '0'
+    })
+    cluster_config = {
+        'endpoint': 'localhost',
+        'settings': {'history': {'path': str(tmpdir), 'window': 5}}
+    }
+    for _ in range(2):
+        slow, stats = dwms.check_durations(cluster_config, 'sample', snapshots, {TODAY: 'SUCCESS'})
+        assert slow == {TODAY: 100}
+
+    history = dwms.SnapshotHistory(str(tmpdir.join('localhost', 'sample.bin')))
+    assert len(history) == 10
+    assert 'snap0' not in history.rows
+    assert not history.add(snapshots[0])
+
+
+def history_row(name, start, duration, status='SUCCESS'):
+    return {
+        'id': name,
+        'status': status,
+        'start_epoch': str(start),
+        'end_epoch': str(start + duration),
+        'total_shards': '10',
+        'failed_shards': '0'
+    }
+
+
+def test_broken_history(tmpdir):
+    """Ensure a history that doesn't add up starts over"""
+    path = tmpdir.join('sample.bin')
+    history = dwms.SnapshotHistory(str(path))
+    for x in range(3):
+        history.add(history_row(f'snap{x}', 1000 * x, 60))
+    history.save()
+    assert len(dwms.SnapshotHistory(str(path))) == 3
+
+    data = path.read_binary()
+    for broken in (data[:-20], data[:10], b'garbage' + data):
+        path.write_binary(broken)
+        assert len(dwms.SnapshotHistory(str(path))) == 0
+
+
+def test_local_repository_history(tmpdir):
+    """Ensure repositories read from storage aren't tracked"""
+    repo = tmpdir.mkdir('repo')
+    repo.join('index-0').write(json.dumps({'snapshots': [{'name': TODAY, 'state': 1}]}))
+    cluster_config = {
+        'endpoint': 'localhost',
+        'settings': {'history': {'path': str(tmpdir.join('history'))}},
+        'repositories': {
+            'local': {'type': 'fs', 'location': str(repo), 'patterns': [TODAY]}
+        }
+    }
+    status = dwms.check_snapshots(cluster_config)
+    assert status['local']['slow'] == {}
+    assert not tmpdir.join('history').exists()
+
+
+class FakeSnapshotClient:
+
+    def __init__(self, states):
+        self.states = states
+        self.asked = None
+
+    def get(self, repository, snapshot, **kwargs):
+        self.asked = snapshot.split(',')
+        return {
+            'snapshots': [
+                {'snapshot': name, 'state': self.states[name]}
+                for name in self.asked if name in self.states
+            ]
+        }
+
+
+@pytest.mark.parametrize('catalog,states,healthy,result', [
+    # 5.x catalog without state, cluster knows it failed
+    ([{'name': TODAY}], {TODAY: 'FAILED'}, True, dwms.Status.FAILED),
+    # Still running, not in the catalog yet
+    ([], {TODAY: 'IN_PROGRESS'}, True, dwms.Status.IN_PROGRESS),
+    # Not in the catalog and the cluster doesn't know it either
+    ([], {}, True, dwms.Status.MISSING),
+    # Can't ask the cluster, don't escalate to missing
+    ([], {}, False, dwms.Status.IN_PROGRESS),
+    # Can't ask the cluster, never assume success
+    ([{'name': TODAY}], {}, False, dwms.Status.FAILED),
+    # Unrestorable snapshots aren't okay
+    ([{'name': TODAY, 'state': 4}], {}, True, dwms.Status.FAILED)
+])
+def test_resolve_local_snapshots(tmpdir, catalog, states, healthy, result):
+    """Ensure what the catalog can't tell is asked of the cluster"""
+    tmpdir.join('index-0').write(json.dumps({'snapshots': catalog}))
+    snapshot = FakeSnapshotClient(states)
+    cluster_config = {
+        'settings': {},
+        'es': type('FakeES', (), {'snapshot': snapshot})(),
+        'repositories': {
+            'local': {'type': 'fs', 'location': str(tmpdir), 'patterns': [TODAY]}
+        }
+    }
+    status = dwms.check_snapshots(cluster_config, healthy)
+    assert dwms.evaluate_snapshots(status) == result
+    if healthy and states:
+        assert snapshot.asked == [TODAY]
+
+
+def test_slow_snapshots_small_durations(tmpdir):
+    """Ensure a second over a 0s median isn't flagged"""
+    snapshots = [history_row(f'snap{x}', 1000 * x, 0) for x in range(5)]
+    snapshots.append(history_row(TODAY, 5000, 1))
+    cluster_config = {
+        'endpoint': 'localhost',
+        'settings': {'history': {'path': str(tmpdir)}}
+    }
+    slow, _ = dwms.check_durations(cluster_config, 'sample', snapshots, {TODAY: 'SUCCESS'})
+    assert slow == {}
+
+
+def test_slow_snapshots_failed_rows(tmpdir):
+    """Ensure failed snapshots don't drag the median down"""
+    snapshots = [history_row(f'snap{x}', 1000 * x, 600) for x in range(5)]
+    snapshots += [history_row(f'fail{x}', 1000 * x + 500, 1, 'FAILED') for x in range(5)]
+    snapshots.append(history_row(TODAY, 5000, 600))
+    cluster_config = {
+        'endpoint': 'localhost',
+        'settings': {'history': {'path': str(tmpdir)}}
+    }
+    slow, stats = dwms.check_durations(cluster_config, 'sample', snapshots, {TODAY: 'SUCCESS'})
+    assert slow == {}
+    assert stats['p50'] == 600
+
+
+def test_slow_snapshots_retaken(tmpdir):
+    """Ensure a retaken snapshot replaces the earlier attempt"""
+    snapshots = [history_row(f'snap{x}', 1000 * x, 60) for x in range(5)]
+    cluster_config = {
+        'endpoint': 'localhost',
+        'settings': {'history': {'path': str(tmpdir)}}
+    }
+    slow, _ = dwms.check_durations(cluster_config, 'sample', snapshots + [history_row(TODAY, 5000, 600)], {TODAY: 'SUCCESS'})
+    assert slow == {TODAY: 600}
+
+    slow, _ = dwms.check_durations(cluster_config, 'sample', snapshots + [history_row(TODAY, 9000, 0)], {TODAY: 'SUCCESS'})
+    assert slow == {}
+
+
+def test_history_without_path():
+    """Ensure a history without a path is turned off up front"""
+    settings = {'username': 'demo', 'password': 'demo', 'history': {'window': 5}}
+    config = {
+        'settings': settings,
+        'clusters': [{'endpoint': 'localhost', 'settings': settings}]
+    }
+    config = dwms.check_history_settings(config)
+    assert not config['clusters'][0]['settings']['history']
+    assert config['settings']['history'] == {'window': 5}